@@ -1,14 +1,20 @@
+import email.utils
+import functools
+import hashlib
 import logging
 import os
-from typing import List, Optional, Dict
+import uuid
+from typing import List, Optional, Dict, Tuple
 
-from fastapi import FastAPI, HTTPException
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
-from pydantic import BaseModel
+import orjson
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, computed_field
 
 # Import services
-from .services import vertex_ai, history
+from .services import vertex_ai, history, tasks
+from .static_files import CachedStaticFiles
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,6 +27,18 @@ static_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static')
 # Determine the path to the index.html file
 index_html_path = os.path.join(static_dir, 'index.html')
 
+# index.html is static for the lifetime of the process, so read it once at startup
+# and serve it from memory with a precomputed validator instead of hitting disk per request.
+try:
+    with open(index_html_path, 'rb') as f:
+        INDEX_BYTES: Optional[bytes] = f.read()
+    INDEX_ETAG = '"' + hashlib.sha1(INDEX_BYTES).hexdigest() + '"'
+    INDEX_MTIME = email.utils.formatdate(os.path.getmtime(index_html_path), usegmt=True)
+except OSError as e:
+    logger.error(f"Could not load index.html from {index_html_path}: {e}")
+    INDEX_BYTES = None
+    INDEX_ETAG = INDEX_MTIME = ""
+
 
 # --- Pydantic Models ---
 
@@ -40,94 +58,208 @@ class HistorySummary(BaseModel):
 
 class HistoryDetail(BaseModel):
     role: str # 'user' or 'model'
-    text: str
+    parts: List[Dict[str, str]] # Stored turn format, e.g. [{"text": "Hello"}]
+
+    @computed_field
+    @property
+    def text(self) -> str:
+        """Plain text of the turn, as used by the web UI."""
+        return "".join(part.get("text", "") for part in self.parts)
 
 
 # --- FastAPI App ---
 
 app = FastAPI(title="Fireside Chat API")
 
+# Compress HTML/JSON responses over 500 bytes. Brotli is used when brotli-asgi is installed
+# (falling back to gzip for clients without 'br'); otherwise plain gzip. Both set
+# 'Vary: Accept-Encoding'. The SSE endpoint is left uncompressed so chunks aren't buffered.
+try:
+    from brotli_asgi import BrotliMiddleware
+    app.add_middleware(BrotliMiddleware, quality=5, minimum_size=500, excluded_handlers=[r"^/api/chat/stream$"])
+except ImportError:
+    app.add_middleware(GZipMiddleware, minimum_size=500)
+
 # Mount the static directory to serve files like CSS, JS
 # Note: App Engine's 'static_dir' handler in app.yaml often handles this,
 # but mounting it here is good practice for local testing and clarity.
 # We use a relative path from the project root for the source path.
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# CachedStaticFiles keeps assets + ETags in memory so returning browsers get a 304.
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
 @app.get("/")
-async def read_index():
-    """Serves the main index.html file."""
-    # Check if index.html exists before serving
-    if os.path.exists(index_html_path):
-        return FileResponse(index_html_path)
-    else:
-        # Use JSONResponse for proper error handling if preferred
-        # return JSONResponse(content={"message": "index.html not found"}, status_code=404)
+async def read_index(request: Request):
+    """Serves the main index.html file from the in-memory copy loaded at startup."""
+    if INDEX_BYTES is None:
         raise HTTPException(status_code=404, detail="index.html not found")
 
+    # Returning browsers already hold this exact version; skip the body entirely.
+    if request.headers.get("if-none-match") == INDEX_ETAG:
+        return Response(status_code=304, headers={"ETag": INDEX_ETAG})
+
+    return Response(
+        INDEX_BYTES,
+        media_type="text/html",
+        headers={
+            "ETag": INDEX_ETAG,
+            "Last-Modified": INDEX_MTIME,
+            "Cache-Control": "public, max-age=300",
+        },
+    )
+
 
 # --- API Endpoints ---
 
+async def _load_llm_history(conversation_id: str) -> Optional[List[Dict]]:
+    """Loads a conversation's turns for the LLM service, or None if not found."""
+    loaded_conversation = await history.load_conversation(conversation_id)
+    if not loaded_conversation:
+        return None
+    # Turns are stored as {"role": ..., "parts": [{"text": ...}]}, which the LLM service takes as-is
+    return loaded_conversation.get("messages", [])
+
+
+async def _save_turn(conversation_id: str, user_prompt: str, model_response: str) -> None:
+    """Persists a turn in the background; the chat session already holds it in memory."""
+    try:
+        await history.save_message(
+            conversation_id=conversation_id,
+            user_prompt=user_prompt,
+            model_response=model_response
+        )
+    except Exception as e:
+        logger.error(f"Error saving turn for conversation {conversation_id}: {e}", exc_info=True)
+
+
+def _check_settings(settings_override: Optional[Dict]) -> None:
+    """Rejects settings the LLM service can't use, before any model call is made."""
+    history_window = (settings_override or {}).get("history_window")
+    if history_window is not None and (isinstance(history_window, bool) or not isinstance(history_window, int) or history_window < 0):
+        raise HTTPException(status_code=400, detail="settings_override.history_window must be a non-negative integer.")
+
+
+async def _resolve_conversation(conversation_id: Optional[str]) -> Tuple[str, Optional[List[Dict]]]:
+    """
+    Returns the conversation ID to use for this turn and, when the LLM service doesn't
+    already have a live session for it, the stored history to rehydrate one from.
+    Unknown or missing IDs start a new conversation. The session can still be dropped before
+    the turn runs, so the handlers also pass the LLM service a loader for existing conversations.
+    """
+    if conversation_id:
+        if vertex_ai.has_session(conversation_id):
+            return conversation_id, None
+        llm_history = await _load_llm_history(conversation_id)
+        if llm_history is not None:
+            return conversation_id, llm_history
+        logger.warning(f"Conversation ID {conversation_id} provided but not found. Starting new.")
+    # New conversations get their ID up front so the chat session can be keyed by it
+    return str(uuid.uuid4()), None
+
+
 @app.post("/api/chat", response_model=ChatResponse)
-async def handle_chat(request: ChatRequest):
+async def handle_chat(request: ChatRequest, background_tasks: BackgroundTasks):
     """Handles a chat request, interacts with the LLM, and saves history."""
     logger.info(f"Received chat request for conversation_id: {request.conversation_id}")
+    _check_settings(request.settings_override)
 
-    conversation_history_turns = []
-    if request.conversation_id:
-        # Load existing conversation history
-        loaded_conversation = history.load_conversation(request.conversation_id)
-        if loaded_conversation:
-            conversation_history_turns = loaded_conversation.get("messages", [])
-            # Convert history format if needed for the LLM service
-            # Assuming vertex_ai.generate_chat_response expects [{"role": ..., "parts": [{"text": ...}]}]
-            # This might need adjustment based on vertex_ai.py implementation details
-            llm_history = []
-            for turn in conversation_history_turns:
-                 if turn.get("role") and turn.get("text"):
-                     llm_history.append({"role": turn["role"], "parts": [{"text": turn["text"]}]})
-                 else:
-                     logger.warning(f"Skipping invalid turn in history: {turn}")
-
-        else:
-            logger.warning(f"Conversation ID {request.conversation_id} provided but not found. Starting new.")
-            request.conversation_id = None # Treat as new conversation
+    conversation_id, llm_history = await _resolve_conversation(request.conversation_id)
+    is_new = conversation_id != request.conversation_id
 
     try:
-        # Call the LLM service
-        model_response_text = vertex_ai.generate_chat_response(
+        # Call the LLM service (waits for a free model-call slot)
+        model_response_text = await tasks.run_chat(
             prompt=request.prompt,
-            conversation_history=llm_history if request.conversation_id else None, # Pass history only if ID exists
-            settings_override=request.settings_override
+            conversation_history=llm_history, # None when the session is cached or the conversation is new
+            settings_override=request.settings_override,
+            conversation_id=conversation_id,
+            history_loader=None if is_new else functools.partial(_load_llm_history, conversation_id)
         )
 
         # Check for errors from the LLM service
         if model_response_text.startswith("Error:"):
              raise HTTPException(status_code=500, detail=model_response_text)
 
+        if is_new:
+            # A new conversation's ID is only handed out once its first turn is on disk
+            await history.save_message(
+                conversation_id=conversation_id,
+                user_prompt=request.prompt,
+                model_response=model_response_text
+            )
+        else:
+            # Save the new turn to history after the response is sent
+            background_tasks.add_task(_save_turn, conversation_id, request.prompt, model_response_text)
 
-        # Save the new turn to history
-        # This returns the conversation ID (either existing or newly generated)
-        updated_conversation_id = history.save_message(
-            conversation_id=request.conversation_id,
-            user_prompt=request.prompt,
-            model_response=model_response_text
-        )
-
-        return ChatResponse(response=model_response_text, conversation_id=updated_conversation_id)
+        return ChatResponse(response=model_response_text, conversation_id=conversation_id)
 
     except HTTPException as http_exc:
         # Re-raise HTTP exceptions directly
         raise http_exc
+    except tasks.QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
     except Exception as e:
         logger.error(f"Error processing chat request: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"An internal error occurred: {e}")
 
 
+@app.post("/api/chat/stream")
+async def handle_chat_stream(request: ChatRequest):
+    """
+    Streaming variant of /api/chat: sends the model's response as Server-Sent Events while it
+    is generated. Each chunk is a JSON-encoded string in a 'data:' line; the stream ends with
+    an 'event: done' (or 'event: error') message. The conversation ID is returned in the
+    X-Conversation-Id header, and history is saved once the full response has been received.
+    """
+    logger.info(f"Received streaming chat request for conversation_id: {request.conversation_id}")
+    _check_settings(request.settings_override)
+
+    conversation_id, llm_history = await _resolve_conversation(request.conversation_id)
+    is_new = conversation_id != request.conversation_id
+
+    async def event_stream():
+        chunks: List[str] = []
+        try:
+            # Holds the conversation's turn lock and a model-call slot for the whole stream
+            async for chunk in tasks.stream_chat(
+                prompt=request.prompt,
+                conversation_history=llm_history,
+                settings_override=request.settings_override,
+                conversation_id=conversation_id,
+                history_loader=None if is_new else functools.partial(_load_llm_history, conversation_id)
+            ):
+                chunks.append(chunk)
+                yield f"data: {orjson.dumps(chunk).decode()}\n\n"
+
+            model_response_text = "".join(chunks)
+            if not model_response_text:
+                # An empty model turn would be skipped when the history is reloaded, leaving two user turns in a row
+                raise ValueError("The model returned an empty response.")
+
+            # Save before signalling completion, so a history refresh triggered by 'done' sees this turn
+            await history.save_message(
+                conversation_id=conversation_id,
+                user_prompt=request.prompt,
+                model_response=model_response_text
+            )
+            yield "event: done\ndata: {}\n\n"
+        except tasks.QueueFullError as e:
+            yield f"event: error\ndata: {orjson.dumps({'detail': str(e)}).decode()}\n\n"
+        except Exception as e:
+            logger.error(f"Error processing streaming chat request: {e}", exc_info=True)
+            yield f"event: error\ndata: {orjson.dumps({'detail': f'An internal error occurred: {e}'}).decode()}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"X-Conversation-Id": conversation_id, "Cache-Control": "no-cache"},
+    )
+
+
 @app.get("/api/history", response_model=List[HistorySummary])
 async def get_history_list():
     """Retrieves a list of conversation summaries."""
     try:
-        summaries = history.list_conversations()
+        summaries = await history.list_conversations()
         # Convert dicts to HistorySummary objects (Pydantic handles this with response_model)
         return summaries
     except Exception as e:
@@ -140,13 +272,13 @@ async def get_conversation_details(conversation_id: str):
     """Retrieves the full message history for a specific conversation."""
     logger.info(f"Requesting history for conversation_id: {conversation_id}")
     try:
-        conversation_data = history.load_conversation(conversation_id)
+        conversation_data = await history.load_conversation(conversation_id)
         if conversation_data is None:
             raise HTTPException(status_code=404, detail="Conversation not found.")
 
         # Extract messages and convert to HistoryDetail objects (Pydantic handles this)
         messages = conversation_data.get("messages", [])
-        return messages # Assuming messages are already in {"role": ..., "text": ...} format
+        return messages # Stored as {"role": ..., "parts": [...]}; HistoryDetail adds 'text'
 
     except ValueError as ve: # Catch invalid ID format from get_conversation_path
          logger.warning(f"Invalid conversation ID format requested: {conversation_id} - {ve}")
@@ -0,0 +1,86 @@
+# fireside/migrate_history.py
+
+"""
+One-off migration of file-backend history to the current storage format.
+
+Rewrites, in place under HISTORY_DIR:
+  - <id>.json files ({"messages": [...]}, from before JSON Lines storage) as <id>.jsonl
+  - turns stored as {"role": ..., "text": ...} as {"role": ..., "parts": [{"text": ...}]}
+
+Run it once, with the app stopped:
+    python -m fireside.migrate_history
+"""
+
+import logging
+import os
+from typing import Dict, List
+
+import orjson
+
+from .services import history
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _upgrade_turns(turns: List[Dict]) -> List[Dict]:
+    """Converts legacy {"role", "text"} turns; turns already in the parts format pass through."""
+    return [
+        history.make_turn(turn["role"], turn["text"]) if "parts" not in turn and "text" in turn else turn
+        for turn in turns
+    ]
+
+
+def _write_jsonl(filepath: str, turns: List[Dict], source_path: str) -> None:
+    """
+    Atomically replaces filepath with one JSON line per turn. The result keeps source_path's
+    access/modification times, since the history list is ordered by them.
+    """
+    source_stat = os.stat(source_path)
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b"".join(orjson.dumps(turn) + b"\n" for turn in turns))
+        f.flush()
+        os.fsync(f.fileno())
+    os.utime(tmp_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    os.replace(tmp_path, filepath)
+
+
+def migrate() -> int:
+    """Migrates every conversation file in HISTORY_DIR. Returns how many files were rewritten."""
+    migrated = 0
+    for filename in sorted(os.listdir(history.HISTORY_DIR)):
+        filepath = os.path.join(history.HISTORY_DIR, filename)
+        try:
+            if filename.endswith(".json"):
+                with open(filepath, 'rb') as f:
+                    turns = orjson.loads(f.read()).get("messages", [])
+                target = filepath[:-5] + ".jsonl"
+                if os.path.exists(target):
+                    logger.warning(f"Skipping {filename}: {os.path.basename(target)} already exists.")
+                    continue
+                _write_jsonl(target, _upgrade_turns(turns), filepath)
+                os.remove(filepath)
+            elif filename.endswith(".jsonl"):
+                with open(filepath, 'rb') as f:
+                    turns = [orjson.loads(line) for line in f if line.strip()]
+                upgraded = _upgrade_turns(turns)
+                if upgraded == turns:
+                    continue
+                _write_jsonl(filepath, upgraded, filepath)
+            else:
+                continue
+            migrated += 1
+            logger.info(f"Migrated {filename}")
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            logger.error(f"Could not migrate {filename}: {e}")
+
+    # Opening the summary index reconciles it with the (possibly renamed) files
+    with history._index_lock:
+        history._get_index()
+    return migrated
+
+
+if __name__ == "__main__":
+    count = migrate()
+    logger.info(f"Migration complete: {count} file(s) rewritten.")
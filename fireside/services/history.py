@@ -2,15 +2,23 @@
 
 """
 Handles saving and retrieving chat conversation history.
-V1: Uses simple JSON files stored on the filesystem.
+V1: Uses one JSON Lines file per conversation (one turn per line) on the filesystem.
+V2: Optionally stores conversations in Redis (HISTORY_BACKEND=redis) so several
+    app instances can share state; the file backend stays the default for local dev.
 """
 
+import asyncio
+from abc import ABC, abstractmethod
 import os
-import json
+import orjson
+import re
+import sqlite3
+import threading
+import time
 import uuid
 from datetime import datetime
 import logging
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, Optional
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -20,28 +28,83 @@ logger = logging.getLogger(__name__)
 HISTORY_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'history') # Store history outside 'fireside' package
 # Ensure the history directory exists
 os.makedirs(HISTORY_DIR, exist_ok=True)
+# Storage backend: "file" (default) or "redis"
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "file").lower()
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+# How many conversations list_conversations returns from the Redis index
+REDIS_LIST_LIMIT = 100
+# SQLite summary index for the file backend, so listing doesn't open every conversation file
+INDEX_DB_PATH = os.path.join(HISTORY_DIR, 'index.sqlite')
+INDEX_LIST_LIMIT = 200
 
 # --- Data Structures ---
-# Structure of a single turn in a conversation
-Turn = Dict[str, str] # e.g., {"role": "user", "text": "Hello"} or {"role": "model", "text": "Hi there!"}
-# Structure of a conversation file
+# Structure of a single turn in a conversation, stored in the shape the Vertex AI SDK takes directly
+Turn = Dict[str, Any] # e.g., {"role": "user", "parts": [{"text": "Hello"}]}
+# Structure of a loaded conversation (the file itself holds one Turn per line)
 Conversation = Dict[str, List[Turn]] # e.g., {"messages": [...]}
 
+# Characters not allowed in a conversation ID (see _safe_id)
+_DISALLOWED_ID_CHARS_RE = re.compile(r'[^A-Za-z0-9_-]')
+# _read_summary reads at most this much of a file; the summary lives in the first line
+SUMMARY_READ_BYTES = 2048
+# First "text" string value in the window. Up to 400 characters or escapes is plenty for an
+# 80-character summary, even with multi-byte UTF-8; group 2 (the closing quote) is None when
+# the value was cut off
+_FIRST_TEXT_RE = re.compile(rb'"text"\s*:\s*"((?:[^"\\]|\\.){0,400})(")?')
+# A \uXXXX escape cut short at the end of a capture (after an even run of backslashes)
+_PARTIAL_ESCAPE_RE = re.compile(rb'(?<!\\)((?:\\\\)*)\\u[0-9a-fA-F]{0,3}$')
+
+# Shared connection to the summary index, opened on first use (see _get_index)
+_index_conn: Optional[sqlite3.Connection] = None
+_index_lock = threading.Lock()
+
 # --- Core Functionality ---
 
-def get_conversation_path(conversation_id: str) -> str:
-    """Constructs the full path for a conversation file."""
-    # Basic sanitization to prevent path traversal
-    safe_id = "".join(c for c in conversation_id if c.isalnum() or c in ['-', '_'])
+def _safe_id(conversation_id: str) -> str:
+    """Strips everything except ASCII letters, digits, '-' and '_' from a conversation ID."""
+    # Basic sanitization to prevent path traversal (and key injection for Redis)
+    safe_id = _DISALLOWED_ID_CHARS_RE.sub('', conversation_id)
     if not safe_id:
         raise ValueError("Invalid conversation ID format.")
-    return os.path.join(HISTORY_DIR, f"{safe_id}.json")
+    return safe_id
+
+def make_turn(role: str, text: str) -> Turn:
+    """Builds a stored turn: {"role": ..., "parts": [{"text": ...}]}."""
+    return {"role": role, "parts": [{"text": text}]}
+
+def turn_text(turn: Turn) -> str:
+    """Returns the text of a stored turn."""
+    return "".join(part.get("text", "") for part in turn.get("parts", []))
+
+def _summarize(text: str, truncated: bool = False) -> str:
+    """Truncates a first message into a history-list summary. truncated marks text already cut short."""
+    return text[:80] + ('...' if truncated or len(text) > 80 else '') # Truncate long summaries
+
+def get_conversation_path(conversation_id: str) -> str:
+    """Constructs the full path for a conversation file."""
+    return os.path.join(HISTORY_DIR, f"{_safe_id(conversation_id)}.jsonl")
 
-def save_message(conversation_id: Optional[str], user_prompt: str, model_response: str) -> str:
+def _warn_about_legacy_files() -> None:
+    """Logs a warning if HISTORY_DIR still holds <id>.json files from before JSON Lines storage."""
+    try:
+        legacy_count = sum(1 for name in os.listdir(HISTORY_DIR) if name.endswith(".json"))
+    except OSError as e:
+        logger.warning(f"Could not check {HISTORY_DIR} for legacy conversation files: {e}")
+        return
+    if legacy_count:
+        logger.warning(
+            f"{legacy_count} conversation file(s) in {HISTORY_DIR} use the old .json format and won't be "
+            "listed or loaded. Run `python -m fireside.migrate_history` once to convert them."
+        )
+
+def _save_message(conversation_id: Optional[str], user_prompt: str, model_response: str) -> str:
     """
     Saves a user prompt and model response to a conversation history file.
     Creates a new conversation file if conversation_id is None.
 
+    Each turn is one JSON line, so saving only appends the new turns instead of
+    re-reading and rewriting the whole conversation.
+
     Args:
         conversation_id: The ID of the existing conversation, or None to start a new one.
         user_prompt: The text of the user's prompt.
@@ -52,42 +115,34 @@ def save_message(conversation_id: Optional[str], user_prompt: str, model_respons
     """
     if conversation_id is None:
         conversation_id = str(uuid.uuid4())
-        conversation_data: Conversation = {"messages": []}
         logger.info(f"Starting new conversation with ID: {conversation_id}")
-    else:
-        try:
-            conversation_data = load_conversation(conversation_id)
-            if conversation_data is None: # Handle case where ID is provided but file doesn't exist
-                 logger.warning(f"Conversation ID {conversation_id} provided, but file not found. Creating new.")
-                 conversation_data = {"messages": []}
-
-        except Exception as e:
-            logger.error(f"Error loading conversation {conversation_id} for saving: {e}", exc_info=True)
-            # Decide on recovery strategy: maybe create new anyway? Or raise error?
-            # For simplicity, let's create a new one if loading fails badly.
-            conversation_id = str(uuid.uuid4())
-            conversation_data = {"messages": []}
-            logger.info(f"Started new conversation {conversation_id} due to load error.")
-
 
-    # Append new turns
-    conversation_data["messages"].append({"role": "user", "text": user_prompt})
-    conversation_data["messages"].append({"role": "model", "text": model_response})
+    lines = (
+        orjson.dumps(make_turn("user", user_prompt)) + b"\n"
+        + orjson.dumps(make_turn("model", model_response)) + b"\n"
+    )
 
-    # Save back to file
+    # Append to file (creates it if the ID is new or the file doesn't exist yet)
+    filepath = None
     try:
         filepath = get_conversation_path(conversation_id)
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(conversation_data, f, indent=2, ensure_ascii=False)
+        with open(filepath, 'ab') as f:
+            is_new = f.tell() == 0 # Append mode starts at the end, so 0 means we just created it
+            f.write(lines)
+            if is_new:
+                # Make sure a freshly created conversation survives a crash before we hand out its ID
+                f.flush()
+                os.fsync(f.fileno())
+        _index_turn(_safe_id(conversation_id), user_prompt)
         logger.info(f"Saved message turn to conversation: {conversation_id}")
         return conversation_id
     except (IOError, ValueError, TypeError) as e:
         logger.error(f"Error saving conversation {conversation_id} to {filepath}: {e}", exc_info=True)
         raise  # Re-raise the exception to be handled by the API layer
 
-def load_conversation(conversation_id: str) -> Optional[Conversation]:
+def _load_conversation(conversation_id: str) -> Optional[Conversation]:
     """
-    Loads a conversation history from its JSON file.
+    Loads a conversation history from its JSON Lines file.
 
     Args:
         conversation_id: The ID of the conversation to load.
@@ -95,68 +150,275 @@ def load_conversation(conversation_id: str) -> Optional[Conversation]:
     Returns:
         The conversation data as a dictionary, or None if the file doesn't exist or is invalid.
     """
+    filepath = None
     try:
         filepath = get_conversation_path(conversation_id)
-        if not os.path.exists(filepath):
-            logger.warning(f"Conversation file not found: {filepath}")
-            return None
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            # Basic validation
-            if isinstance(data, dict) and "messages" in data and isinstance(data["messages"], list):
-                 logger.info(f"Loaded conversation: {conversation_id}")
-                 return data
-            else:
-                 logger.error(f"Invalid format in conversation file: {filepath}")
-                 return None # Or raise an error?
-    except (IOError, json.JSONDecodeError, ValueError) as e:
+        messages = []
+        # Open directly; a missing file surfaces as FileNotFoundError instead of a separate exists() stat
+        with open(filepath, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    messages.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    # A torn trailing line from an interrupted append shouldn't lose the whole conversation
+                    logger.warning(f"Skipping malformed line in conversation file: {filepath}")
+        logger.info(f"Loaded conversation: {conversation_id}")
+        return {"messages": messages}
+    except FileNotFoundError:
+        logger.warning(f"Conversation file not found: {filepath}")
+        return None
+    except (IOError, ValueError) as e:
         logger.error(f"Error loading conversation {conversation_id} from {filepath}: {e}", exc_info=True)
         return None # Or raise? Returning None might be safer for API stability.
 
-def list_conversations() -> List[Dict[str, str]]:
+def _read_summary(filepath: str) -> str:
+    """
+    Reads the first turn of a conversation file and returns it, truncated, as a summary.
+    Only the first SUMMARY_READ_BYTES are read; the whole first line is parsed only when
+    the prompt is too long to fit in that window and the prefix regex can't find it.
     """
-    Lists available conversations based on the files in the history directory.
+    summary = "Conversation" # Default summary
+    truncated = False
+    try:
+        with open(filepath, 'rb') as f:
+            head = f.read(SUMMARY_READ_BYTES)
+            newline = head.find(b"\n")
+            if newline != -1:
+                # The whole first turn fits in the window; parse it exactly
+                text = turn_text(orjson.loads(head[:newline]))
+            else:
+                match = _FIRST_TEXT_RE.search(head)
+                text = None
+                if match:
+                    # Escapes like \u0001 take six bytes per character, so the capture may hold fewer than 80
+                    truncated = match.group(2) is None
+                    prefix = match.group(1)
+                    if truncated:
+                        prefix = _PARTIAL_ESCAPE_RE.sub(rb'\1', prefix)
+                    try:
+                        # Unescape the (possibly cut-off) JSON string prefix
+                        text = orjson.loads(b'"' + prefix.decode('utf-8', 'ignore').encode() + b'"')
+                    except orjson.JSONDecodeError:
+                        # e.g. a surrogate pair split by the cut; parse the whole line instead
+                        truncated = False
+                if text is None:
+                    f.seek(0)
+                    text = turn_text(orjson.loads(f.readline()))
+            if text:
+                summary = _summarize(text, truncated)
+    except Exception as e:
+        logger.warning(f"Could not read summary from {filepath}: {e}")
+        # Keep default summary
+    return summary
 
-    Returns:
-        A list of dictionaries, each containing 'id' and 'summary' (first message).
-        Returns an empty list if the directory doesn't exist or on error.
+def _get_index() -> sqlite3.Connection:
+    """
+    Returns the summary index connection, creating the database on first use.
+    Callers must hold _index_lock, since the connection is shared across worker threads.
+    """
+    global _index_conn
+    if _index_conn is None:
+        conn = sqlite3.connect(INDEX_DB_PATH, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS conv(id TEXT PRIMARY KEY, summary TEXT, mtime REAL)")
+        _reconcile_index(conn)
+        _index_conn = conn
+    return _index_conn
+
+def _reconcile_index(conn: sqlite3.Connection) -> None:
+    """
+    Brings the index in line with the conversation files once per process: adds files the
+    index doesn't know about (e.g. written before it existed) and drops rows whose file is gone.
     """
-    if not os.path.isdir(HISTORY_DIR):
-        logger.warning(f"History directory not found: {HISTORY_DIR}")
-        return []
+    indexed = {row[0] for row in conn.execute("SELECT id FROM conv")}
+    on_disk = set()
+    with os.scandir(HISTORY_DIR) as it:
+        for entry in it:
+            if not entry.name.endswith(".jsonl"):
+                continue
+            conversation_id = entry.name[:-6] # Remove .jsonl extension
+            on_disk.add(conversation_id)
+            if conversation_id not in indexed:
+                conn.execute(
+                    "INSERT OR IGNORE INTO conv(id, summary, mtime) VALUES (?, ?, ?)",
+                    (conversation_id, _read_summary(entry.path), entry.stat().st_mtime)
+                )
+    stale = indexed - on_disk
+    if stale:
+        conn.executemany("DELETE FROM conv WHERE id = ?", [(conversation_id,) for conversation_id in stale])
+    logger.info(f"Summary index reconciled: {len(on_disk - indexed)} added, {len(stale)} removed.")
 
-    conversations = []
+def _index_turn(safe_id: str, user_prompt: str) -> None:
+    """Records a saved turn in the summary index; only the first turn sets the summary."""
     try:
-        for filename in os.listdir(HISTORY_DIR):
-            if filename.endswith(".json"):
-                conversation_id = filename[:-5] # Remove .json extension
-                filepath = os.path.join(HISTORY_DIR, filename)
-                summary = "Conversation" # Default summary
-                timestamp = datetime.fromtimestamp(os.path.getmtime(filepath)).strftime('%Y-%m-%d %H:%M')
-
-                # Try to load the first message as a summary
-                try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        if data and "messages" in data and data["messages"]:
-                            first_message = data["messages"][0]
-                            if first_message and "text" in first_message:
-                                summary = first_message["text"][:80] + ('...' if len(first_message["text"]) > 80 else '') # Truncate long summaries
-                except Exception as e:
-                    logger.warning(f"Could not read summary from {filename}: {e}")
-                    # Keep default summary
-
-                conversations.append({
-                    "id": conversation_id,
-                    "summary": summary,
-                    "last_modified": timestamp
-                })
-
-        # Sort by last modified time, newest first
-        conversations.sort(key=lambda x: x["last_modified"], reverse=True)
+        with _index_lock:
+            _get_index().execute(
+                "INSERT INTO conv(id, summary, mtime) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET mtime = excluded.mtime",
+                (safe_id, _summarize(user_prompt), time.time())
+            )
+    except (sqlite3.Error, OSError) as e:
+        # The conversation file is the source of truth; the next reconcile picks it up
+        logger.warning(f"Could not update summary index for {safe_id}: {e}")
+
+def _list_conversations() -> List[Dict[str, str]]:
+    """
+    Lists available conversations from the summary index.
+
+    Returns:
+        A list of dictionaries, each containing 'id', 'summary' (first message) and
+        'last_modified', newest first. Returns an empty list on error.
+    """
+    try:
+        with _index_lock:
+            rows = _get_index().execute(
+                "SELECT id, summary, mtime FROM conv ORDER BY mtime DESC LIMIT ?", (INDEX_LIST_LIMIT,)
+            ).fetchall()
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Error listing conversations from {INDEX_DB_PATH}: {e}", exc_info=True)
+        return [] # Return empty list on error
+
+    conversations = [
+        {
+            "id": conversation_id,
+            "summary": summary or "Conversation",
+            "last_modified": datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M'),
+        }
+        for conversation_id, summary, mtime in rows
+    ]
+    logger.info(f"Found {len(conversations)} conversations.")
+    return conversations
+
+# --- Backends ---
+
+class HistoryBackend(ABC):
+    """Interface shared by the history storage backends."""
+
+    @abstractmethod
+    async def save_message(self, conversation_id: Optional[str], user_prompt: str, model_response: str) -> str:
+        """Appends a user/model turn, starting a new conversation if conversation_id is None. Returns the ID."""
+
+    @abstractmethod
+    async def load_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        """Returns {"messages": [...]} for a conversation, or None if it doesn't exist."""
+
+    @abstractmethod
+    async def list_conversations(self) -> List[Dict[str, str]]:
+        """Returns conversation summaries ('id', 'summary', 'last_modified'), newest first."""
+
+
+class FileBackend(HistoryBackend):
+    """
+    Stores each conversation as a JSON Lines file under HISTORY_DIR.
+    The file work is blocking, so it runs in a worker thread to keep the event loop free.
+    """
+
+    async def save_message(self, conversation_id: Optional[str], user_prompt: str, model_response: str) -> str:
+        return await asyncio.to_thread(_save_message, conversation_id, user_prompt, model_response)
+
+    async def load_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        return await asyncio.to_thread(_load_conversation, conversation_id)
+
+    async def list_conversations(self) -> List[Dict[str, str]]:
+        return await asyncio.to_thread(_list_conversations)
+
+
+class RedisBackend(HistoryBackend):
+    """
+    Stores conversations in Redis:
+      conv:{id}          LIST of JSON-encoded turns, appended with RPUSH
+      conv:summary:{id}  first user prompt, truncated, for the history list
+      conv:index         ZSET of conversation IDs scored by last-modified time
+    """
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("HISTORY_BACKEND=redis requires the 'redis' package (pip install redis).") from e
+        self.redis = redis_asyncio.from_url(url)
+        logger.info(f"Using Redis history backend at {url}")
+
+    async def save_message(self, conversation_id: Optional[str], user_prompt: str, model_response: str) -> str:
+        if conversation_id is None:
+            conversation_id = str(uuid.uuid4())
+            logger.info(f"Starting new conversation with ID: {conversation_id}")
+        safe_id = _safe_id(conversation_id)
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.rpush(
+            f"conv:{safe_id}",
+            orjson.dumps(make_turn("user", user_prompt)),
+            orjson.dumps(make_turn("model", model_response)),
+        )
+        pipe.set(f"conv:summary:{safe_id}", _summarize(user_prompt), nx=True) # Only the first turn sets it
+        pipe.zadd("conv:index", {safe_id: time.time()})
+        await pipe.execute()
+        logger.info(f"Saved message turn to conversation: {conversation_id}")
+        return conversation_id
+
+    async def load_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        try:
+            safe_id = _safe_id(conversation_id)
+        except ValueError as e:
+            logger.error(f"Error loading conversation {conversation_id}: {e}")
+            return None
+        turns = await self.redis.lrange(f"conv:{safe_id}", 0, -1)
+        if not turns:
+            logger.warning(f"Conversation not found in Redis: {conversation_id}")
+            return None
+        logger.info(f"Loaded conversation: {conversation_id}")
+        return {"messages": [orjson.loads(turn) for turn in turns]}
+
+    async def list_conversations(self) -> List[Dict[str, str]]:
+        # Already ordered newest first by the index
+        entries = await self.redis.zrevrange("conv:index", 0, REDIS_LIST_LIMIT - 1, withscores=True)
+        if not entries:
+            return []
+        ids = [conversation_id.decode() for conversation_id, _ in entries]
+        summaries = await self.redis.mget([f"conv:summary:{conversation_id}" for conversation_id in ids])
+        conversations = [
+            {
+                "id": conversation_id,
+                "summary": summary.decode() if summary else "Conversation",
+                "last_modified": datetime.fromtimestamp(score).strftime('%Y-%m-%d %H:%M'),
+            }
+            for conversation_id, (_, score), summary in zip(ids, entries, summaries)
+        ]
         logger.info(f"Found {len(conversations)} conversations.")
         return conversations
 
-    except OSError as e:
-        logger.error(f"Error listing conversations in {HISTORY_DIR}: {e}", exc_info=True)
-        return [] # Return empty list on error
+
+_backend: Optional[HistoryBackend] = None
+
+def get_backend() -> HistoryBackend:
+    """Returns the configured history backend, creating it on first use."""
+    global _backend
+    if _backend is None:
+        if HISTORY_BACKEND == "redis":
+            _backend = RedisBackend(REDIS_URL)
+        else:
+            if HISTORY_BACKEND != "file":
+                logger.warning(f"Unknown HISTORY_BACKEND '{HISTORY_BACKEND}', falling back to file storage.")
+            _backend = FileBackend()
+    return _backend
+
+# --- Async API ---
+# Used by the FastAPI handlers; delegates to the configured backend.
+
+async def save_message(conversation_id: Optional[str], user_prompt: str, model_response: str) -> str:
+    """Saves a turn to the configured backend; see _save_message for details."""
+    return await get_backend().save_message(conversation_id, user_prompt, model_response)
+
+async def load_conversation(conversation_id: str) -> Optional[Conversation]:
+    """Loads a conversation from the configured backend; see _load_conversation for details."""
+    return await get_backend().load_conversation(conversation_id)
+
+async def list_conversations() -> List[Dict[str, str]]:
+    """Lists conversations from the configured backend, newest first."""
+    return await get_backend().list_conversations()
+
+if HISTORY_BACKEND != "redis":
+    _warn_about_legacy_files()
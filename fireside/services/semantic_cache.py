@@ -0,0 +1,119 @@
+# fireside/services/semantic_cache.py
+
+"""
+Process-local semantic cache for model responses.
+Prompts (plus the tail of their conversation) are embedded via the google-generativeai SDK;
+a new prompt whose embedding is close enough to a cached one reuses that response
+instead of making another generation call.
+"""
+
+import math
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import google.generativeai as genai
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+EMBEDDING_MODEL_ID = os.environ.get("SEMANTIC_CACHE_EMBEDDING_MODEL", "models/text-embedding-004")
+# Cosine similarity required for a hit. Unset disables the cache unless a request
+# passes "score_threshold" in settings_override.
+_env_threshold = os.environ.get("SEMANTIC_CACHE_THRESHOLD")
+DEFAULT_SCORE_THRESHOLD: Optional[float] = float(_env_threshold) if _env_threshold else None
+MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "512"))
+TTL_SECONDS = int(os.environ.get("SEMANTIC_CACHE_TTL_SECONDS", "3600"))
+# How many previous turns are folded into the cache key alongside the prompt
+HISTORY_TAIL_TURNS = 2
+
+Vector = List[float]
+
+
+class SemanticCache:
+    """Bounded, TTL'd store of (namespace, unit vector) -> response, searched by cosine similarity."""
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[int, Tuple[Hashable, Vector, str, float]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, namespace: Hashable, vector: Vector, threshold: float) -> Optional[str]:
+        """Returns the best cached response scoring at least `threshold`, or None."""
+        now = time.monotonic()
+        best_id, best_score = None, threshold
+        with self._lock:
+            for entry_id, (entry_namespace, entry_vector, _, expires_at) in list(self._entries.items()):
+                if expires_at < now:
+                    del self._entries[entry_id]
+                    continue
+                if entry_namespace != namespace:
+                    continue
+                # Vectors are stored normalized, so the dot product is the cosine similarity
+                score = math.sumprod(vector, entry_vector)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            logger.info(f"Semantic cache hit (score {best_score:.3f}).")
+            return self._entries[best_id][2]
+
+    def add(self, namespace: Hashable, vector: Vector, response: str) -> None:
+        """Stores a response, evicting the least recently used entry when full."""
+        with self._lock:
+            self._entries[self._next_id] = (namespace, vector, response, time.monotonic() + self.ttl_seconds)
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_cache = SemanticCache(MAX_ENTRIES, TTL_SECONDS)
+
+
+def resolve_threshold(settings_override: Optional[Dict]) -> Optional[float]:
+    """Returns the similarity threshold for this request, or None when caching is off."""
+    if settings_override and settings_override.get("score_threshold") is not None:
+        return float(settings_override["score_threshold"])
+    return DEFAULT_SCORE_THRESHOLD
+
+
+def key_text(prompt: str, conversation_history: Optional[List[Dict]]) -> str:
+    """Builds the text that identifies a request: the last few turns plus the prompt."""
+    parts = []
+    for turn in (conversation_history or [])[-HISTORY_TAIL_TURNS:]:
+        for part in turn.get("parts", []):
+            parts.append(part if isinstance(part, str) else part.get("text", ""))
+    parts.append(prompt)
+    return "\n".join(parts)
+
+
+async def embed(text: str) -> Optional[Vector]:
+    """Embeds text and normalizes it to unit length. Returns None if the embedding call fails."""
+    try:
+        result = await genai.embed_content_async(model=EMBEDDING_MODEL_ID, content=text)
+        vector = result["embedding"]
+    except Exception as e:
+        logger.warning(f"Semantic cache embedding failed, skipping cache: {e}")
+        return None
+    norm = math.sqrt(math.sumprod(vector, vector))
+    if not norm:
+        return None
+    return [value / norm for value in vector]
+
+
+def lookup(namespace: Hashable, vector: Vector, threshold: float) -> Optional[str]:
+    """Looks up a cached response in the process-wide cache."""
+    return _cache.lookup(namespace, vector, threshold)
+
+
+def add(namespace: Hashable, vector: Vector, response: str) -> None:
+    """Adds a response to the process-wide cache."""
+    _cache.add(namespace, vector, response)
@@ -0,0 +1,86 @@
+# fireside/services/tasks.py
+
+"""
+Bounded-concurrency execution of model calls.
+At most MAX_CONCURRENT_MODEL_CALLS requests talk to Vertex AI at once; the rest wait for a
+slot (up to QUEUE_TIMEOUT_SECONDS) instead of piling onto the upstream quota.
+Turns on one conversation also run one at a time; they wait for the conversation's lock
+before taking a slot, so a queue on one conversation doesn't hold slots others could use.
+"""
+
+import asyncio
+import os
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+from . import vertex_ai
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Match this to the Vertex AI QPS quota available to one instance
+MAX_CONCURRENT_MODEL_CALLS = int(os.environ.get("VERTEX_MAX_CONCURRENCY", "8"))
+QUEUE_TIMEOUT_SECONDS = float(os.environ.get("VERTEX_QUEUE_TIMEOUT_SECONDS", "30"))
+
+# Created on first use in the running loop (see _get_slots)
+_slots: Optional[asyncio.Semaphore] = None
+_slots_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+class QueueFullError(Exception):
+    """Raised when no model-call slot frees up within QUEUE_TIMEOUT_SECONDS."""
+
+
+def _get_slots() -> asyncio.Semaphore:
+    """Returns the slot semaphore for the running event loop (a new loop, e.g. after a reload, gets a fresh one)."""
+    global _slots, _slots_loop
+    loop = asyncio.get_running_loop()
+    if _slots is None or _slots_loop is not loop:
+        _slots = asyncio.Semaphore(MAX_CONCURRENT_MODEL_CALLS)
+        _slots_loop = loop
+    return _slots
+
+
+@asynccontextmanager
+async def model_slot() -> AsyncIterator[None]:
+    """Holds one of the model-call slots for the duration of the block."""
+    slots = _get_slots()
+    try:
+        await asyncio.wait_for(slots.acquire(), QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning(f"No model-call slot free after {QUEUE_TIMEOUT_SECONDS}s; rejecting request.")
+        raise QueueFullError("The model is busy, please retry shortly.")
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+async def run_chat(prompt: str, conversation_history: Optional[List[Dict]] = None, settings_override: Optional[Dict] = None, conversation_id: Optional[str] = None, history_loader: Optional[vertex_ai.HistoryLoader] = None) -> str:
+    """Runs vertex_ai.generate_chat_response once the conversation's turn lock and then a slot are available."""
+    async with vertex_ai.session_lock(conversation_id):
+        async with model_slot():
+            return await vertex_ai.generate_chat_response(
+                prompt=prompt,
+                conversation_history=conversation_history,
+                settings_override=settings_override,
+                conversation_id=conversation_id,
+                history_loader=history_loader
+            )
+
+
+async def stream_chat(prompt: str, conversation_history: Optional[List[Dict]] = None, settings_override: Optional[Dict] = None, conversation_id: Optional[str] = None, history_loader: Optional[vertex_ai.HistoryLoader] = None) -> AsyncIterator[str]:
+    """Streams vertex_ai.stream_chat_response like run_chat, holding the lock and slot until the stream ends."""
+    async with vertex_ai.session_lock(conversation_id):
+        async with model_slot():
+            async for chunk in vertex_ai.stream_chat_response(
+                prompt=prompt,
+                conversation_history=conversation_history,
+                settings_override=settings_override,
+                conversation_id=conversation_id,
+                history_loader=history_loader
+            ):
+                yield chunk
@@ -5,10 +5,15 @@ Handles interaction with Google Vertex AI Gemini models using the google-generat
 configured for Vertex AI endpoints and ADC authentication.
 """
 
+import asyncio
 import os
+import threading
+from collections import OrderedDict
 import google.generativeai as genai
 import logging
-from typing import List, Dict, Optional
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Optional, Tuple
+
+from . import semantic_cache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,16 +26,274 @@ logger = logging.getLogger(__name__)
 
 # We still allow overriding the default model via an environment variable.
 DEFAULT_MODEL_ID = os.environ.get("VERTEX_MODEL_ID", "gemini-1.5-flash-latest") # Keep this name consistent if used in app.yaml override
+# How many previous turns (user + model messages) are sent to the model; 0 sends them all.
+# Requests can override it with settings_override["history_window"].
+DEFAULT_HISTORY_WINDOW = int(os.environ.get("HISTORY_WINDOW_TURNS", "20"))
 
 # --- Initialization ---
 # No explicit genai.init() needed here when relying on environment variables for Vertex AI config.
 # The SDK handles initialization automatically upon first use (e.g., when GenerativeModel is called).
 logger.info("Google AI SDK will attempt auto-configuration for Vertex AI based on environment variables.")
 
+# GenerativeModel instances are reused across requests, one per model ID.
+_MODEL_CACHE: Dict[str, genai.GenerativeModel] = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+
+# Live ChatSessions keyed by conversation ID, so follow-up turns don't reload and reformat the
+# history from storage. Sessions are per process; set this to 0 when several instances share
+# one history store (e.g. HISTORY_BACKEND=redis behind a load balancer).
+# Each entry also holds the conversation's turn lock (see session_lock); dropping a session
+# keeps the entry, so requests already waiting on the lock still run one at a time.
+MAX_SESSIONS = int(os.environ.get("CHAT_SESSION_CACHE_SIZE", "1000"))
+_SESSIONS: "OrderedDict[str, Tuple[asyncio.Lock, Optional[genai.ChatSession]]]" = OrderedDict()
+_SESSIONS_LOCK = threading.Lock()
+
+# Responses to deterministic one-shot prompts, keyed by (model_id, prompt, generation config)
+MAX_CACHED_RESPONSES = 1024
+_RESPONSE_CACHE: "OrderedDict[Tuple, str]" = OrderedDict()
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+# Finish reasons of a complete response; anything else (SAFETY, RECITATION, ...) means it was cut off
+_OK_FINISH_REASONS = (
+    genai.protos.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED,
+    genai.protos.Candidate.FinishReason.STOP,
+    genai.protos.Candidate.FinishReason.MAX_TOKENS,
+)
+
+
+# Fetches a conversation's stored turns (or None), for rehydrating a session that isn't cached
+HistoryLoader = Callable[[], Awaitable[Optional[List[Dict]]]]
+
 
 # --- Core Functionality ---
 
-def generate_chat_response(prompt: str, conversation_history: Optional[List[Dict]] = None, settings_override: Optional[Dict] = None) -> str:
+def _get_model(model_id: str) -> genai.GenerativeModel:
+    """Returns the shared GenerativeModel for model_id, constructing it on first use."""
+    model = _MODEL_CACHE.get(model_id)
+    if model is None:
+        with _MODEL_CACHE_LOCK:
+            model = _MODEL_CACHE.get(model_id)
+            if model is None:
+                model = _MODEL_CACHE[model_id] = genai.GenerativeModel(model_id)
+    return model
+
+
+def has_session(conversation_id: str) -> bool:
+    """Whether a live chat session (and therefore its history) is cached for this conversation."""
+    with _SESSIONS_LOCK:
+        entry = _SESSIONS.get(conversation_id)
+        return entry is not None and entry[1] is not None
+
+
+def drop_session(conversation_id: str) -> None:
+    """Forgets a cached session; the next turn rehydrates it from stored history."""
+    with _SESSIONS_LOCK:
+        entry = _SESSIONS.get(conversation_id)
+        if entry is not None:
+            _SESSIONS[conversation_id] = (entry[0], None)
+
+
+def _evict_sessions() -> None:
+    """Drops the least recently used entries beyond MAX_SESSIONS. Callers must hold _SESSIONS_LOCK."""
+    while len(_SESSIONS) > MAX_SESSIONS:
+        _SESSIONS.popitem(last=False)
+
+
+def session_lock(conversation_id: Optional[str]) -> asyncio.Lock:
+    """
+    Returns the lock that turns on a conversation hold while they use its session (see
+    tasks.run_chat). Concurrent turns would otherwise interleave on one ChatSession and lose
+    one of them from its history.
+    """
+    if not conversation_id or MAX_SESSIONS <= 0:
+        return asyncio.Lock() # No cached session, so nothing is shared
+    with _SESSIONS_LOCK:
+        entry = _SESSIONS.get(conversation_id)
+        if entry is None:
+            entry = _SESSIONS[conversation_id] = (asyncio.Lock(), None)
+            _evict_sessions()
+        else:
+            _SESSIONS.move_to_end(conversation_id)
+        return entry[0]
+
+
+async def _get_session(conversation_id: str, model_id: str, conversation_history: Optional[List[Dict]], history_loader: Optional[HistoryLoader]) -> genai.ChatSession:
+    """
+    Returns the cached ChatSession for a conversation, creating it on a miss from
+    conversation_history, or from history_loader when no history was passed in (the session
+    may have been dropped or evicted after the caller checked has_session). A session created
+    for a different model is rebuilt with the same history. Callers hold the conversation's lock.
+    """
+    model = _get_model(model_id)
+    with _SESSIONS_LOCK:
+        entry = _SESSIONS.get(conversation_id)
+        chat_session = entry[1] if entry is not None else None
+        if chat_session is not None and chat_session.model is model:
+            _SESSIONS.move_to_end(conversation_id)
+            return chat_session
+
+    if chat_session is not None:
+        chat_session = model.start_chat(history=chat_session.history)
+    else:
+        if conversation_history is None and history_loader is not None:
+            conversation_history = await history_loader()
+        chat_session = model.start_chat(history=_format_history(conversation_history))
+    if MAX_SESSIONS > 0:
+        with _SESSIONS_LOCK:
+            entry = _SESSIONS.get(conversation_id)
+            _SESSIONS[conversation_id] = (entry[0] if entry is not None else asyncio.Lock(), chat_session)
+            _SESSIONS.move_to_end(conversation_id)
+            _evict_sessions()
+    return chat_session
+
+
+def _session_turns(chat_session: genai.ChatSession, last_n: int) -> List[Dict]:
+    """Returns the last turns of a session's history as {"role", "parts": [text]} dicts."""
+    return [
+        {"role": content.role, "parts": [part.text for part in content.parts]}
+        for content in chat_session.history[-last_n:]
+    ] if last_n else []
+
+
+def _history_window(settings_override: Optional[Dict]) -> int:
+    """Returns how many previous turns to send for this request (0 means no limit)."""
+    if settings_override and settings_override.get("history_window") is not None:
+        return int(settings_override["history_window"])
+    return DEFAULT_HISTORY_WINDOW
+
+
+def _trim_history(turns: List, window: int) -> List:
+    """
+    Keeps the last `window` turns, dropping a leading model turn so the history still
+    starts with the user. Works on turn dicts and on SDK Content objects.
+    """
+    if window <= 0 or len(turns) <= window:
+        return turns
+    trimmed = turns[-window:]
+    while trimmed and (trimmed[0].get("role") if isinstance(trimmed[0], dict) else trimmed[0].role) != "user":
+        trimmed = trimmed[1:]
+    return trimmed
+
+
+def _windowed_session(chat_session: genai.ChatSession, window: int) -> genai.ChatSession:
+    """
+    Returns the session to send this turn on: chat_session itself when its history fits the
+    window, otherwise a temporary session holding just the windowed turns. The cached session
+    keeps its full history, so the window only limits what this request sends.
+    """
+    history = chat_session.history
+    trimmed = _trim_history(history, window)
+    if len(trimmed) == len(history):
+        return chat_session
+    return chat_session.model.start_chat(history=trimmed)
+
+
+def _keep_turn(chat_session: genai.ChatSession, turn_session: genai.ChatSession) -> None:
+    """Adds a turn answered on a temporary windowed session (see _windowed_session) to the cached one."""
+    if turn_session is not chat_session:
+        chat_session.history = chat_session.history + turn_session.history[-2:]
+
+
+def _record_turn(chat_session: genai.ChatSession, prompt: str, model_response: str) -> None:
+    """Adds a turn answered without the session (e.g. from a cache) to its history."""
+    chat_session.history = chat_session.history + [
+        {"role": "user", "parts": [prompt]},
+        {"role": "model", "parts": [model_response]},
+    ]
+
+
+def _extract_response_text(response) -> str:
+    """Extracts the text from a genai response, or an "Error: ..." message if there is none."""
+    if response.parts:
+        model_response = "".join(part.text for part in response.parts)
+        logger.info("Successfully received response from Vertex AI (via genai SDK).")
+        return model_response
+    elif response.candidates and response.candidates[0].content.parts:
+        model_response = "".join(part.text for part in response.candidates[0].content.parts)
+        logger.info("Successfully received response from Vertex AI (via genai SDK candidates).")
+        return model_response
+    else:
+        try:
+            _ = response.text # Check for blocks
+        except ValueError as ve:
+            logger.error(f"Response blocked or invalid: {ve}. Full response: {response}")
+            return f"Error: Model response blocked or invalid. Reason: {ve}"
+        except Exception as e_text:
+            logger.error(f"Could not extract text from response. Error: {e_text}. Response: {response}")
+
+        logger.error(f"Could not extract text response from Vertex AI (via genai SDK): {response}")
+        return "Error: Could not parse the model's response (empty or unexpected format)."
+
+
+def _resolve_settings(settings_override: Optional[Dict]) -> Tuple[str, Dict]:
+    """Determines the model ID and generation config overrides for a request."""
+    current_model_id = DEFAULT_MODEL_ID # Start with default
+    gen_config_overrides = {}
+    if settings_override:
+        current_model_id = settings_override.get("model_id", DEFAULT_MODEL_ID)
+        if "temperature" in settings_override:
+            gen_config_overrides["temperature"] = settings_override["temperature"]
+        if "max_output_tokens" in settings_override:
+            gen_config_overrides["max_output_tokens"] = settings_override["max_output_tokens"]
+        # Add other supported parameters (top_p, top_k) if needed
+    # When using Vertex AI backend, model names might need the 'models/' prefix,
+    # but genai library often handles this. Test if prefix is needed.
+    # Example: model = genai.GenerativeModel(f"models/{current_model_id}")
+    return current_model_id, gen_config_overrides
+
+
+def _generation_config(gen_config_overrides: Dict) -> Optional[genai.types.GenerationConfig]:
+    """Builds a GenerationConfig from the overrides, or None to use the model defaults."""
+    return genai.types.GenerationConfig(**gen_config_overrides) if gen_config_overrides else None
+
+
+def _format_history(conversation_history: Optional[List[Dict]]) -> List[Dict]:
+    """Formats history turns for the google-genai library, skipping invalid ones."""
+    formatted_history = []
+    if conversation_history:
+        for turn in conversation_history:
+            role = turn.get("role")
+            parts_list = turn.get("parts", [])
+            text_content = ""
+            if parts_list and isinstance(parts_list, list) and len(parts_list) > 0:
+                first_part = parts_list[0]
+                if isinstance(first_part, dict) and "text" in first_part:
+                    text_content = first_part["text"]
+                elif isinstance(first_part, str):
+                    text_content = first_part
+
+            if role and text_content:
+                # Ensure role is 'user' or 'model' as expected by genai
+                valid_role = "model" if role.lower() == "model" else "user"
+                formatted_history.append({"role": valid_role, "parts": [text_content]})
+            else:
+                logger.warning(f"Skipping invalid history turn for google-genai: {turn}")
+    return formatted_history
+
+
+async def _call_model(model_id: str, prompt: str, gen_config_items: Tuple) -> str:
+    """
+    One-shot (no history) generation, memoized on its exact inputs in a process-local LRU.
+    Only used for deterministic requests (temperature 0), where a repeat prompt
+    would get the same answer anyway. "Error: ..." results are not cached.
+    """
+    key = (model_id, prompt, gen_config_items)
+    with _RESPONSE_CACHE_LOCK:
+        if key in _RESPONSE_CACHE:
+            _RESPONSE_CACHE.move_to_end(key)
+            return _RESPONSE_CACHE[key]
+
+    response = await _get_model(model_id).generate_content_async(prompt, generation_config=_generation_config(dict(gen_config_items)))
+    model_response = _extract_response_text(response)
+    if not model_response.startswith("Error"):
+        with _RESPONSE_CACHE_LOCK:
+            _RESPONSE_CACHE[key] = model_response
+            while len(_RESPONSE_CACHE) > MAX_CACHED_RESPONSES:
+                _RESPONSE_CACHE.popitem(last=False)
+    return model_response
+
+
+async def generate_chat_response(prompt: str, conversation_history: Optional[List[Dict]] = None, settings_override: Optional[Dict] = None, conversation_id: Optional[str] = None, history_loader: Optional[HistoryLoader] = None) -> str:
     """
     Sends a prompt to the configured Vertex AI Gemini model via the google-generativeai SDK.
 
@@ -38,8 +301,16 @@ def generate_chat_response(prompt: str, conversation_history: Optional[List[Dict
         prompt: The user's input prompt.
         conversation_history: A list of previous turns in the conversation, if any.
                               Expected format: [{"role": "user", "parts": ["text"]}, {"role": "model", "parts": ["text"]}]
+                              Only used to create the chat session when one isn't cached for conversation_id.
         settings_override: Optional dictionary to override default model parameters
-                           (e.g., model_id, temperature, max_output_tokens).
+                           (e.g., model_id, temperature, max_output_tokens), the semantic
+                           cache similarity threshold (score_threshold), and how many
+                           previous turns to send (history_window).
+        conversation_id: If given, the turn runs on this conversation's cached chat session,
+                         which keeps the history between calls (see has_session). The caller
+                         must hold session_lock(conversation_id).
+        history_loader: Optional callback returning the conversation's stored history, used to
+                        rehydrate the session when it isn't cached and conversation_history is None.
 
     Returns:
         The text response from the model.
@@ -49,76 +320,125 @@ def generate_chat_response(prompt: str, conversation_history: Optional[List[Dict
     # If env vars are missing, the model call below will likely raise an error.
 
     try:
-        # Determine model and generation config
-        current_model_id = DEFAULT_MODEL_ID # Start with default
-        gen_config_overrides = {}
-        if settings_override:
-            current_model_id = settings_override.get("model_id", DEFAULT_MODEL_ID)
-            if "temperature" in settings_override:
-                gen_config_overrides["temperature"] = settings_override["temperature"]
-            if "max_output_tokens" in settings_override:
-                gen_config_overrides["max_output_tokens"] = settings_override["max_output_tokens"]
-            # Add other supported parameters (top_p, top_k) if needed
-
-        # When using Vertex AI backend, model names might need the 'models/' prefix,
-        # but genai library often handles this. Test if prefix is needed.
-        # Example: model = genai.GenerativeModel(f"models/{current_model_id}")
-        model = genai.GenerativeModel(current_model_id)
-
-        # Format history for the google-genai library
-        formatted_history = []
-        if conversation_history:
-            for turn in conversation_history:
-                role = turn.get("role")
-                parts_list = turn.get("parts", [])
-                text_content = ""
-                if parts_list and isinstance(parts_list, list) and len(parts_list) > 0:
-                     first_part = parts_list[0]
-                     if isinstance(first_part, dict) and "text" in first_part:
-                         text_content = first_part["text"]
-                     elif isinstance(first_part, str):
-                         text_content = first_part
-
-                if role and text_content:
-                     # Ensure role is 'user' or 'model' as expected by genai
-                     valid_role = "model" if role.lower() == "model" else "user"
-                     formatted_history.append({"role": valid_role, "parts": [text_content]})
-                else:
-                     logger.warning(f"Skipping invalid history turn for google-genai: {turn}")
-
-
-        logger.info(f"Sending request to Vertex AI model: {current_model_id} via genai SDK with history length: {len(formatted_history)}")
-
-        # Start chat session if history exists, otherwise generate directly
-        if formatted_history:
-            chat_session = model.start_chat(history=formatted_history)
-            response = chat_session.send_message(prompt, generation_config=genai.types.GenerationConfig(**gen_config_overrides) if gen_config_overrides else None)
-        else:
-            response = model.generate_content(prompt, generation_config=genai.types.GenerationConfig(**gen_config_overrides) if gen_config_overrides else None)
-
-
-        # --- Response Parsing (same as before for genai) ---
-        if response.parts:
-             model_response = "".join(part.text for part in response.parts)
-             logger.info("Successfully received response from Vertex AI (via genai SDK).")
-             return model_response
-        elif response.candidates and response.candidates[0].content.parts:
-             model_response = "".join(part.text for part in response.candidates[0].content.parts)
-             logger.info("Successfully received response from Vertex AI (via genai SDK candidates).")
-             return model_response
+        current_model_id, gen_config_overrides = _resolve_settings(settings_override)
+        model = _get_model(current_model_id)
+        # Bound the history sent per turn, so token cost and latency don't grow with the conversation
+        history_window = _history_window(settings_override)
+        if conversation_id:
+            chat_session = await _get_session(conversation_id, current_model_id, conversation_history, history_loader)
+            turn_session = _windowed_session(chat_session, history_window)
+            history_length = len(turn_session.history)
         else:
-             try:
-                 _ = response.text # Check for blocks
-             except ValueError as ve:
-                 logger.error(f"Response blocked or invalid: {ve}. Full response: {response}")
-                 return f"Error: Model response blocked or invalid. Reason: {ve}"
-             except Exception as e_text:
-                 logger.error(f"Could not extract text from response. Error: {e_text}. Response: {response}")
+            chat_session = None
+            formatted_history = _trim_history(_format_history(conversation_history), history_window)
+            history_length = len(formatted_history)
+
+        gen_config_items = tuple(sorted(gen_config_overrides.items()))
+        # Deterministic one-shot prompts: serve exact repeats from the process-local LRU
+        if not history_length and gen_config_overrides.get("temperature") == 0:
+            logger.info(f"Sending cacheable request to Vertex AI model: {current_model_id} via genai SDK")
+            model_response = await _call_model(current_model_id, prompt, gen_config_items)
+            if model_response.startswith("Error"):
+                return model_response
+            if chat_session:
+                _record_turn(chat_session, prompt, model_response)
+            return model_response
 
-             logger.error(f"Could not extract text response from Vertex AI (via genai SDK): {response}")
-             return "Error: Could not parse the model's response (empty or unexpected format)."
+        # Reuse a cached answer for a semantically equivalent request, if the cache is enabled
+        cache_vector = None
+        score_threshold = semantic_cache.resolve_threshold(settings_override)
+        # Answers are only reused for the same model and generation config
+        cache_namespace = (current_model_id, gen_config_items)
+        if score_threshold is not None:
+            history_tail = (_session_turns(chat_session, semantic_cache.HISTORY_TAIL_TURNS) if chat_session
+                            else formatted_history)
+            cache_vector = await semantic_cache.embed(semantic_cache.key_text(prompt, history_tail))
+            if cache_vector:
+                cached_response = semantic_cache.lookup(cache_namespace, cache_vector, score_threshold)
+                if cached_response is not None:
+                    if chat_session:
+                        _record_turn(chat_session, prompt, cached_response)
+                    return cached_response
 
+        logger.info(f"Sending request to Vertex AI model: {current_model_id} via genai SDK with history length: {history_length}")
+
+        # Continue the conversation's session; otherwise start one if history exists, or generate directly
+        if chat_session:
+            response = await turn_session.send_message_async(prompt, generation_config=_generation_config(gen_config_overrides))
+        elif formatted_history:
+            response = await model.start_chat(history=formatted_history).send_message_async(prompt, generation_config=_generation_config(gen_config_overrides))
+        else:
+            response = await model.generate_content_async(prompt, generation_config=_generation_config(gen_config_overrides))
+
+        model_response = _extract_response_text(response)
+        if model_response.startswith("Error"):
+            if conversation_id:
+                # The session now ends in a blocked/broken turn that won't be saved; rebuild it next time
+                drop_session(conversation_id)
+            return model_response
+        if chat_session:
+            _keep_turn(chat_session, turn_session)
+        if cache_vector:
+            semantic_cache.add(cache_namespace, cache_vector, model_response)
+        return model_response
 
     except Exception as e:
         logger.error(f"Error calling Vertex AI (via google-generativeai): {e}", exc_info=True)
-        return f"Error communicating with the AI model: {e}"
+        if conversation_id:
+            drop_session(conversation_id)
+        return f"Error: Could not communicate with the AI model: {e}" # "Error:" prefix, so callers treat it as a failure
+
+
+async def stream_chat_response(prompt: str, conversation_history: Optional[List[Dict]] = None, settings_override: Optional[Dict] = None, conversation_id: Optional[str] = None, history_loader: Optional[HistoryLoader] = None) -> AsyncIterator[str]:
+    """
+    Streaming variant of generate_chat_response: yields text chunks as the model produces them.
+    The response caches are bypassed. Errors are raised rather than returned as "Error: ..."
+    strings, because by the time one happens part of the response may already be sent.
+
+    Args:
+        prompt: The user's input prompt.
+        conversation_history: Previous turns, in the same format as generate_chat_response.
+        settings_override: Optional model parameter overrides (model_id, temperature, max_output_tokens,
+                           history_window).
+        conversation_id: If given, the turn runs on this conversation's cached chat session
+                         (the caller must hold session_lock(conversation_id) until the stream ends).
+        history_loader: As for generate_chat_response.
+
+    Yields:
+        Successive pieces of the model's response text.
+    """
+    current_model_id, gen_config_overrides = _resolve_settings(settings_override)
+    history_window = _history_window(settings_override)
+    completed = False
+    try:
+        if conversation_id:
+            chat_session = await _get_session(conversation_id, current_model_id, conversation_history, history_loader)
+            turn_session = _windowed_session(chat_session, history_window)
+        else:
+            chat_session = None
+            turn_session = _get_model(current_model_id).start_chat(history=_trim_history(_format_history(conversation_history), history_window))
+
+        logger.info(f"Streaming request to Vertex AI model: {current_model_id} via genai SDK with history length: {len(turn_session.history)}")
+        response = await turn_session.send_message_async(prompt, generation_config=_generation_config(gen_config_overrides), stream=True)
+        received_text = False
+        async for chunk in response:
+            if chunk.parts:
+                received_text = True
+                yield "".join(part.text for part in chunk.parts)
+
+        # The SDK doesn't raise for a stream that stops early (e.g. SAFETY, RECITATION); check it here
+        candidate = response.candidates[0] if response.candidates else None
+        if candidate is None or candidate.finish_reason not in _OK_FINISH_REASONS:
+            logger.error(f"Streamed response blocked or incomplete. Full response: {response}")
+            reason = candidate.finish_reason.name if candidate is not None else "no candidates"
+            raise ValueError(f"Model response blocked or incomplete. Reason: {reason}")
+        if not received_text:
+            raise ValueError("The model returned an empty response.")
+        if chat_session:
+            _keep_turn(chat_session, turn_session)
+        completed = True
+        logger.info("Finished streaming response from Vertex AI (via genai SDK).")
+    finally:
+        if conversation_id and not completed:
+            # A failed, blocked or abandoned stream leaves a broken turn in the session; rebuild it next time
+            drop_session(conversation_id)
@@ -0,0 +1,58 @@
+# fireside/static_files.py
+
+"""
+StaticFiles variant that keeps small assets and their ETags in memory.
+Returning browsers get a 304 from a header comparison instead of a fresh file send.
+"""
+
+import functools
+import hashlib
+import mimetypes
+import os
+import re
+from typing import Tuple
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Scope
+
+# Files larger than this are streamed from disk by the stock StaticFiles path.
+MAX_CACHED_FILE_SIZE = 1024 * 1024
+# Assets whose name carries a content hash (e.g. app.3f9a1c2b.js) never change in place.
+FINGERPRINTED_RE = re.compile(r"\.[0-9a-fA-F]{8,}\.\w+$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Plain names (style.css, script.js) can change under the same URL, so always revalidate;
+# the ETag turns that revalidation into a 304.
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+
+@functools.lru_cache(maxsize=256)
+def _load_asset(full_path: str, mtime_ns: int, size: int) -> Tuple[str, bytes]:
+    """Reads an asset and computes its ETag. mtime_ns/size are part of the cache key only."""
+    with open(full_path, 'rb') as f:
+        data = f.read()
+    etag = '"' + hashlib.blake2b(data, digest_size=16).hexdigest() + '"'
+    return etag, data
+
+
+class CachedStaticFiles(StaticFiles):
+    """Serves static files from an in-memory LRU, keyed by path + mtime + size."""
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        if status_code != 200 or stat_result.st_size > MAX_CACHED_FILE_SIZE:
+            return super().file_response(full_path, stat_result, scope, status_code)
+
+        full_path = str(full_path)
+        etag, data = _load_asset(full_path, stat_result.st_mtime_ns, stat_result.st_size)
+        if FINGERPRINTED_RE.search(full_path):
+            cache_control = IMMUTABLE_CACHE_CONTROL
+        else:
+            cache_control = REVALIDATE_CACHE_CONTROL
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+
+        if Headers(scope=scope).get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+        media_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        return Response(data, media_type=media_type, headers=headers)
@@ -14,7 +14,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- Functions ---
 
-    /** Adds a message to the chat output area */
+    /** Adds a message to the chat output area and returns its text node */
     function addMessage(role, text) {
         const messageDiv = document.createElement('div');
         messageDiv.classList.add('message', role); // 'user' or 'model'
@@ -31,6 +31,41 @@ document.addEventListener('DOMContentLoaded', () => {
         chatOutput.appendChild(messageDiv);
         // Scroll to the bottom
         chatOutput.scrollTop = chatOutput.scrollHeight;
+        return textNode;
+    }
+
+    /** Reads a Server-Sent Events response, calling onChunk for each text chunk */
+    async function readEventStream(response, onChunk) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // Events are separated by a blank line
+            let separatorIndex;
+            while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, separatorIndex);
+                buffer = buffer.slice(separatorIndex + 2);
+
+                let eventName = 'message';
+                let data = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                });
+
+                if (eventName === 'error') {
+                    throw new Error(JSON.parse(data).detail);
+                } else if (eventName === 'done') {
+                    return;
+                } else if (data) {
+                    onChunk(JSON.parse(data));
+                }
+            }
+        }
     }
 
     /** Adds a loading indicator to the chat output */
@@ -147,7 +182,7 @@ document.addEventListener('DOMContentLoaded', () => {
         promptInput.value = ''; // Clear input field
 
         try {
-            const response = await fetch('/api/chat', {
+            const response = await fetch('/api/chat/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -171,12 +206,17 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(errorDetail);
             }
 
-            const data = await response.json();
-            addMessage('model', data.response);
+            // Render the response as it streams in
+            const conversationId = response.headers.get('X-Conversation-Id');
+            const textNode = addMessage('model', '');
+            await readEventStream(response, chunk => {
+                textNode.appendData(chunk);
+                chatOutput.scrollTop = chatOutput.scrollHeight;
+            });
 
             // If it was a new chat, update the conversation ID and reload history
-            if (currentConversationId !== data.conversation_id) {
-                currentConversationId = data.conversation_id;
+            if (currentConversationId !== conversationId) {
+                currentConversationId = conversationId;
                 loadHistoryList(); // Refresh history list to show the new chat
                  // Update active state in history list for the new conversation
                 document.querySelectorAll('#history-list li').forEach(li => {